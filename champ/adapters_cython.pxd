@@ -1,2 +1 @@
 cdef int hamming_distance(char *, char *, int, int, int)
-cdef int simple_hamming_distance(char *, char *)
@@ -15,15 +15,37 @@ cdef int hamming_distance(char *read,
     cdef int mismatches = 0
     cdef int i
 
+    # The comparison is added rather than branched on, which lets the compiler vectorize the loop
     for i in range(compare_length):
-        if read[start + i] != adapter[i]:
-            mismatches += 1
+        mismatches += read[start + i] != adapter[i]
 
     return mismatches
 
 def simple_hamming_distance(first, second):
     return hamming_distance(first, second, len(first), len(second), 0)
 
+@cython.boundscheck(False)
+@cython.wraparound(False)
+def unique_overlap_length(seq1, seq2_rc, int min_len, int max_len, double[:] max_ham_dists):
+    """
+    Finds the one length i for which the first i bases of seq1 and the last i bases of seq2_rc differ at fewer than
+    max_ham_dists[i - min_len] positions. Returns -1 if no length or more than one length qualifies.
+    """
+    cdef int seq1_length = len(seq1)
+    cdef int seq2_length = len(seq2_rc)
+    cdef char *first = seq1
+    cdef char *second = seq2_rc
+    cdef int loc_max_len = min(max_len, seq1_length, seq2_length, min_len + max_ham_dists.shape[0] - 1)
+    cdef int found = -1
+    cdef int i
+
+    for i in range(min_len, loc_max_len + 1):
+        if hamming_distance(first, second + seq2_length - i, i, i, 0) < max_ham_dists[i - min_len]:
+            if found != -1:
+                return -1
+            found = i
+    return found
+
 cdef int cython_hamming_with_N(char *ref, char *seq, int compare_length):
     """
     Test hamming distance, where Ns in the first sequence don't count.
@@ -32,8 +54,7 @@ cdef int cython_hamming_with_N(char *ref, char *seq, int compare_length):
     cdef int i
 
     for i in range(compare_length):
-        if 'N' != ref[i] != seq[i]:
-            mismatches += 1
+        mismatches += (ref[i] != 'N') & (ref[i] != seq[i])
 
     return mismatches
 
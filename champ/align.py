@@ -1,52 +1,62 @@
+from __future__ import print_function, division
 import matplotlib
 matplotlib.use('Agg')
-import matplotlib.pyplot as plt
-from champ.grid import GridImages
+from matplotlib.backends.backend_agg import FigureCanvasAgg
+from matplotlib.figure import Figure
+from champ.grid import GridImages, image_index
 from champ import plotting, fastqimagealigner, stats, error
-from collections import Counter, defaultdict
+from collections import defaultdict, deque
 import functools
 import h5py
 import logging
 import multiprocessing
-from multiprocessing import Manager
+from multiprocessing.pool import ThreadPool
+import itertools
 import os
-import sys
 import re
-from copy import deepcopy
-import math
-import gc
 
 log = logging.getLogger(__name__)
 stats_regex = re.compile(r'''^(\w+)_(?P<row>\d+)_(?P<column>\d+)_stats\.txt$''')
-
-
-def run(cluster_strategy, rotation_adjustment, h5_filenames, path_info, snr, min_hits, fia, end_tiles, alignment_channel, all_tile_data, metadata, make_pdfs, sequencing_chip, process_limit, side1):
-    image_count = count_images(h5_filenames, alignment_channel)
-    num_processes, chunksize = calculate_process_count(image_count)
-    if process_limit > 0:
-        num_processes = min(process_limit, num_processes)
+_grid_cache = {}
+# Set in the end tile workers so they can skip columns that are no longer needed
+_stop_event = None
+# The aligner with the reads loaded. It's set in the parent before a pool is created so the forked workers
+# share it, rather than unpickling a copy of every read with each batch of tasks.
+_parent_fia = None
+# Diagnostic figures, keyed by size. Each worker reuses its own rather than building new ones for every image.
+_figures = {}
+
+
+def run(cluster_strategy, rotation_adjustment, h5_filenames, path_info, snr, min_hits, fia, end_tiles, alignment_channel, all_tile_data, metadata, make_pdfs, sequencing_chip, process_limit, side1, chunksize=None):
+    num_processes = calculate_process_count(process_limit)
+    if chunksize is None:
+        chunksize = calculate_chunksize(count_images(h5_filenames, alignment_channel), num_processes)
     log.debug("Aligning alignment images with %d cores with chunksize %d" % (num_processes, chunksize))
 
     # Iterate over images that are probably inside an Illumina tile, attempt to align them, and if they
     # align, do a precision alignment and write the mapped FastQ reads to disk
+    global _parent_fia
+    _parent_fia = fia
     alignment_func = functools.partial(perform_alignment, cluster_strategy, rotation_adjustment, path_info, snr, min_hits, metadata['microns_per_pixel'],
-                                       sequencing_chip, all_tile_data, make_pdfs, fia, side1)
-
-    for h5_filename in h5_filenames:
-        pool = multiprocessing.Pool(num_processes)
-        pool.map_async(alignment_func,
-                       iterate_all_images([h5_filename], end_tiles, alignment_channel, path_info), chunksize=chunksize).get(timeout=sys.maxint)
-        pool.close()
-        pool.join()
+                                       sequencing_chip, all_tile_data, make_pdfs, side1)
+
+    # A single pool serves every HDF5 file so workers are only forked once. Workers are recycled periodically
+    # to keep their memory usage bounded.
+    pool = multiprocessing.Pool(num_processes, maxtasksperchild=128, initializer=disable_file_locking)
+    for _ in pool.imap_unordered(alignment_func,
+                                 iterate_all_images(h5_filenames, end_tiles, alignment_channel, path_info),
+                                 chunksize=chunksize):
+        pass
+    pool.close()
+    pool.join()
+    _parent_fia = None
 
     log.debug("Done aligning!")
 
 
-def run_data_channel(cluster_strategy, h5_filenames, channel_name, path_info, alignment_tile_data, all_tile_data, metadata, clargs, process_limit):
-    image_count = count_images(h5_filenames, channel_name)
-    num_processes, chunksize = calculate_process_count(image_count)
-    if process_limit > 0:
-        num_processes = min(process_limit, num_processes)
+def run_data_channel(cluster_strategy, h5_filenames, channel_name, path_info, alignment_tile_data, all_tile_data, metadata, clargs, process_limit, chunksize=8):
+    # Every data image gets a full precision alignment, so small chunks keep the workers evenly loaded
+    num_processes = calculate_process_count(process_limit)
     log.debug("Aligning data images with %d cores with chunksize %d" % (num_processes, chunksize))
 
     # Here we load only the phiX reads to FASTQ Image Aligner
@@ -54,18 +64,20 @@ def run_data_channel(cluster_strategy, h5_filenames, channel_name, path_info, al
     fastq_image_aligner = fastqimagealigner.FastqImageAligner(metadata['microns_per_pixel'])
     fastq_image_aligner.load_reads(alignment_tile_data)
     log.debug("Reads loaded.")
+    global _parent_fia
+    _parent_fia = fastq_image_aligner
     second_processor = functools.partial(process_data_image, cluster_strategy, path_info, all_tile_data,
                                          clargs.microns_per_pixel, clargs.make_pdfs,
-                                         channel_name, fastq_image_aligner, clargs.min_hits)
-    for h5_filename in h5_filenames:
-        pool = multiprocessing.Pool(num_processes)
-        log.debug("Doing second channel alignment of all images with %d cores" % num_processes)
-        pool.map_async(second_processor,
-                       load_aligned_stats_files([h5_filename], metadata['alignment_channel'], path_info),
-                       chunksize=chunksize).get(sys.maxint)
-        pool.close()
-        pool.join()
-        gc.collect()
+                                         channel_name, clargs.min_hits)
+    pool = multiprocessing.Pool(num_processes, maxtasksperchild=128, initializer=disable_file_locking)
+    log.debug("Doing second channel alignment of all images with %d cores" % num_processes)
+    for _ in pool.imap_unordered(second_processor,
+                                 load_aligned_stats_files(h5_filenames, metadata['alignment_channel'], path_info),
+                                 chunksize=chunksize):
+        pass
+    pool.close()
+    pool.join()
+    _parent_fia = None
 
     log.debug("Done aligning!")
 
@@ -78,7 +90,7 @@ def alignment_is_complete(stats_file_path):
 
 
 def perform_alignment(cluster_strategy, rotation_adjustment, path_info, snr, min_hits, um_per_pixel, sequencing_chip, all_tile_data,
-                      make_pdfs, prefia, side1, image_data):
+                      make_pdfs, side1, image_data):
     # Does a rough alignment, and if that works, does a precision alignment and writes the corrected
     # FastQ reads to disk
     try:
@@ -92,7 +104,7 @@ def perform_alignment(cluster_strategy, rotation_adjustment, path_info, snr, min
 
         log.debug("Aligning image from %s. Row: %d, Column: %d " % (base_name, image.row, image.column))
         # first get the correlation to random tiles, so we can distinguish signal from noise
-        fia = process_alignment_image(cluster_strategy, rotation_adjustment, snr, sequencing_chip, base_name, um_per_pixel, image, possible_tile_keys, deepcopy(prefia), side1)
+        fia = process_alignment_image(cluster_strategy, rotation_adjustment, snr, sequencing_chip, base_name, um_per_pixel, image, possible_tile_keys, _parent_fia.clone_for_image(), side1)
 
         if fia.hitting_tiles:
             # The image data aligned with FastQ reads!
@@ -104,25 +116,41 @@ def perform_alignment(cluster_strategy, rotation_adjustment, path_info, snr, min
             else:
                 result = write_output(stats_file_path, image.index, base_name, fia, path_info, all_tile_data, make_pdfs, um_per_pixel)
                 print("Write alignment for %s: %s" % (image.index, result))
-        # Force the GC to run, since otherwise memory usage blows up
-        del fia
-        del image
-        gc.collect()
     except IndexError:
         # This happens and we don't know why. We'll just throw out the data since it's very rare
         pass
 
 
 def make_output_directories(h5_filenames, path_info):
-    for h5_filename in h5_filenames:
-        base_name = os.path.splitext(h5_filename)[0]
-        for directory in (path_info.figure_directory, path_info.results_directory):
-            full_directory = os.path.join(directory, base_name)
-            if not os.path.exists(full_directory):
-                os.makedirs(full_directory)
+    directories = [os.path.join(directory, os.path.splitext(h5_filename)[0])
+                   for h5_filename in h5_filenames
+                   for directory in (path_info.figure_directory, path_info.results_directory)]
+    map_in_threads(make_directory, directories)
 
 
-def get_end_tiles(cluster_strategies, rotation_adjustment, h5_filenames, alignment_channel, snr, metadata, sequencing_chip, fia, side1):
+def make_directory(full_directory):
+    try:
+        os.makedirs(full_directory)
+    except OSError:
+        # another thread may have created it (or one of its parents) first
+        if not os.path.isdir(full_directory):
+            raise
+
+
+def map_in_threads(func, items, max_threads=16):
+    # The startup steps that touch every HDF5 file spend their time waiting on the filesystem rather than
+    # computing, so threads are enough to overlap them
+    if not items:
+        return []
+    pool = ThreadPool(min(max_threads, len(items)))
+    try:
+        return pool.map(func, items)
+    finally:
+        pool.close()
+        pool.join()
+
+
+def get_end_tiles(cluster_strategy, rotation_adjustment, h5_filenames, alignment_channel, snr, metadata, sequencing_chip, fia, side1):
 
     # -----------------------------------
     # To reduce the time for alignment, champ program strategically find the image boundary in the FASTQ space by aligning the first image to the tiles #2101 to # 2109,
@@ -130,23 +158,18 @@ def get_end_tiles(cluster_strategies, rotation_adjustment, h5_filenames, alignme
     # Otherwise, the alignment will fail.
     # -----------------------------------
 
-    right_end_tiles = {}
-    left_end_tiles = {}
-    # For rough alignment, we first try ".se" strategy from source extractor. If it .se strategy fails, champ then try with ".otsu" from Otsu's method.
-    for cluster_strategy in cluster_strategies:
-        with h5py.File(h5_filenames[0]) as first_file:
-            grid = GridImages(first_file, alignment_channel)
-            # no reason to use all cores yet, since we're IO bound?
-            num_processes = len(h5_filenames)
-            pool = multiprocessing.Pool(num_processes)
-            base_column_checker = functools.partial(check_column_for_alignment, cluster_strategy, rotation_adjustment, alignment_channel, snr, sequencing_chip, metadata['microns_per_pixel'], fia, int(side1))
-            # Retrieve the left and right end tiles information
-            left_end_tiles = dict(find_bounds(pool, h5_filenames, base_column_checker, grid.columns, sequencing_chip.left_side_tiles))
-            right_end_tiles = dict(find_bounds(pool, h5_filenames, base_column_checker, reversed(grid.columns), sequencing_chip.right_side_tiles))
-            pool.close()
-            pool.join()
-            if left_end_tiles and right_end_tiles:
-                break
+    with open_h5(h5_filenames[0]) as first_file:
+        grid = GridImages(first_file, alignment_channel)
+        # no reason to use all cores yet, since we're IO bound?
+        num_processes = len(h5_filenames)
+        stop_event = multiprocessing.Event()
+        pool = multiprocessing.Pool(num_processes, initializer=set_stop_event, initargs=(stop_event,))
+        base_column_checker = functools.partial(check_column_for_alignment, cluster_strategy, rotation_adjustment, alignment_channel, snr, sequencing_chip, metadata['microns_per_pixel'], fia, int(side1))
+        # Retrieve the left and right end tiles information
+        left_end_tiles = dict(find_bounds(pool, stop_event, h5_filenames, base_column_checker, grid.columns, sequencing_chip.left_side_tiles))
+        right_end_tiles = dict(find_bounds(pool, stop_event, h5_filenames, base_column_checker, reversed(grid.columns), sequencing_chip.right_side_tiles))
+        pool.close()
+        pool.join()
     # There are several parameters affecting the alignment outcomes, such as rotation angle, pixel size, flipping, and ports position. It could also be possible that the acquired images only cover part of either end tiles.
     if not left_end_tiles or not right_end_tiles:
         error.fail("End tiles could not be found! Try adjusting the rotation or look at the raw images.")
@@ -171,56 +194,52 @@ def build_end_tiles(h5_filenames, experiment_chip, left_end_tiles, default_left_
 
 
 def count_images(h5_filenames, channel):
-    image_count = 0
-    for h5_filename in h5_filenames:
-        with h5py.File(h5_filename, 'r') as h5:
-            grid = GridImages(h5, channel)
-            image_count += len(grid)
-    return image_count
+    return sum(map_in_threads(functools.partial(count_file_images, channel), h5_filenames))
+
 
+def count_file_images(channel, h5_filename):
+    with open_h5(h5_filename) as h5:
+        return GridImages.count_only(h5, channel)
 
-def calculate_process_count(image_count):
+
+def calculate_process_count(process_limit):
     # Leave at least two processors free so we don't totally hammer the server
     num_processes = max(multiprocessing.cpu_count() - 2, 1)
-    # we add 1 to the chunksize to ensure that at most one processor will have less than a full workload the entire time
-    # we set the minimum to 32 to ensure that in small datasets, we have constant throughput
-    chunksize = min(32, int(math.ceil(float(image_count) / float(num_processes))) + 1)
-    return num_processes, chunksize
+    if process_limit > 0:
+        num_processes = min(process_limit, num_processes)
+    return num_processes
 
 
-def extract_rc_info(stats_file):
-    match = stats_regex.match(stats_file)
-    if match:
-        return int(match.group('row')), int(match.group('column'))
-    raise ValueError("Invalid stats file: %s" % str(stats_file))
+def calculate_chunksize(image_count, num_processes):
+    # Give each process about eight chunks, so large runs (which are mostly images that were already aligned
+    # and get skipped quickly) send tasks in big batches, while the work still evens out at the end
+    return max(4, min(256, image_count // (num_processes * 8) + 1))
 
 
 def load_aligned_stats_files(h5_filenames, alignment_channel, path_info):
     for h5_filename in h5_filenames:
         base_name = os.path.splitext(h5_filename)[0]
         for filename in os.listdir(os.path.join(path_info.results_directory, base_name)):
-            if filename.endswith('_stats.txt') and alignment_channel in filename:
-                try:
-                    row, column = extract_rc_info(filename)
-                except ValueError:
-                    log.warn("Invalid stats file: %s" % str(filename))
-                    continue
-                else:
-                    yield h5_filename, base_name, filename, row, column
+            if not filename.endswith('_stats.txt') or alignment_channel not in filename:
+                continue
+            match = stats_regex.match(filename)
+            if match is None:
+                log.warn("Invalid stats file: %s" % str(filename))
+                continue
+            yield h5_filename, base_name, filename, int(match.group('row')), int(match.group('column'))
 
 
 def process_data_image(cluster_strategy, path_info, all_tile_data, um_per_pixel, make_pdfs, channel,
-                       fastq_image_aligner, min_hits, (h5_filename, base_name, stats_filepath, row, column)):
+                       min_hits, image_data):
+    h5_filename, base_name, stats_filepath, row, column = image_data
     image = load_image(h5_filename, channel, row, column)
     alignment_stats_file_path = os.path.join(path_info.results_directory, base_name, stats_filepath)
     data_stats_file_path = os.path.join(path_info.results_directory, base_name, '{}_stats.txt'.format(image.index))
     if alignment_is_complete(data_stats_file_path):
         log.debug("Already aligned %s from %s" % (image.index, h5_filename))
-        del image
-        gc.collect()
         return
     sexcat_filepath = os.path.join(base_name, '%s.clusters.%s' % (image.index, cluster_strategy))
-    local_fia = deepcopy(fastq_image_aligner)
+    local_fia = _parent_fia.clone_for_image()
     local_fia.set_image_data(image, um_per_pixel)
     local_fia.set_sexcat_from_file(sexcat_filepath, cluster_strategy)
     local_fia.alignment_from_alignment_file(alignment_stats_file_path)
@@ -231,16 +250,28 @@ def process_data_image(cluster_strategy, path_info, all_tile_data, um_per_pixel,
     else:
         log.debug("Processed data channel for %s" % image.index)
         write_output(data_stats_file_path, image.index, base_name, local_fia, path_info, all_tile_data, make_pdfs, um_per_pixel)
-    finally:
-        del local_fia
-        del image
-    gc.collect()
 
 
 def load_image(h5_filename, channel, row, column):
-    with h5py.File(h5_filename) as h5:
-        grid = GridImages(h5, channel)
-        return grid.get(row, column)
+    return load_grid(h5_filename, channel).get(row, column)
+
+
+def open_h5(h5_filename):
+    # Alignment never modifies the image files. Opening them read-only (h5py otherwise defaults to
+    # read/write) lets every worker open the same file at once.
+    return h5py.File(h5_filename, 'r')
+
+
+def load_grid(h5_filename, channel):
+    # Workers load many images from the same few files, so each process keeps its HDF5 files open and
+    # only parses the grid of each channel once. Keying on the PID keeps forked workers from reusing
+    # handles that belong to their parent.
+    key = os.getpid(), h5_filename, channel
+    grid = _grid_cache.get(key)
+    if grid is None:
+        grid = GridImages(open_h5(h5_filename), channel)
+        _grid_cache[key] = grid
+    return grid
 
 
 def decide_default_tiles_and_columns(end_tiles):
@@ -250,28 +281,74 @@ def decide_default_tiles_and_columns(end_tiles):
         for tile in tiles:
             all_tiles.append(tile)
         columns.append(column)
-    best_tile, best_column = Counter(all_tiles).most_common(1)[0][0], Counter(columns).most_common(1)[0][0]
+    best_tile, best_column = most_common(all_tiles), most_common(columns)
     return best_tile, best_column
 
 
-def find_bounds(pool, h5_filenames, base_column_checker, columns, possible_tile_keys):
-    end_tiles = Manager().dict()
-    for column in columns:
-        column_checker = functools.partial(base_column_checker, end_tiles, column, possible_tile_keys)
-        pool.map_async(column_checker, h5_filenames).get(sys.maxint)
+def most_common(items):
+    # Finds the most frequent item in a single pass. Ties go to whichever item reached that count first.
+    counts = defaultdict(int)
+    best, best_count = None, 0
+    for item in items:
+        counts[item] += 1
+        if counts[item] > best_count:
+            best, best_count = item, counts[item]
+    return best
+
+
+def disable_file_locking():
+    # Alignment workers only ever read the image files, so there is nothing for HDF5's file locks to protect, and
+    # without them the workers don't serialize on the lock (which is especially slow on network filesystems). This
+    # is only done in the workers, so anything that writes HDF5 files keeps its locks. A value set by the user still
+    # takes precedence.
+    os.environ.setdefault('HDF5_USE_FILE_LOCKING', 'FALSE')
+
+
+def set_stop_event(stop_event):
+    global _stop_event
+    _stop_event = stop_event
+    disable_file_locking()
+
+
+def find_bounds(pool, stop_event, h5_filenames, base_column_checker, columns, possible_tile_keys, window=4):
+    # Usually one of the first few columns aligns, so we queue up several columns at once rather than
+    # waiting for each one to finish before starting the next. Results are still examined in column
+    # order, and once a column aligns the workers are told to skip the columns queued after it.
+    stop_event.clear()
+    columns = iter(columns)
+    pending = deque()
+
+    def submit(column):
+        column_checker = functools.partial(base_column_checker, column, possible_tile_keys)
+        pending.append(pool.map_async(column_checker, h5_filenames))
+
+    for column in itertools.islice(columns, window):
+        submit(column)
+    while pending:
+        end_tiles = dict(result for result in pending.popleft().get() if result is not None)
         if end_tiles:
+            stop_event.set()
+            for async_result in pending:
+                async_result.wait()
             return end_tiles
+        for column in itertools.islice(columns, 1):
+            submit(column)
     return {}
 
 
 def check_column_for_alignment(cluster_strategy, rotation_adjustment, channel, snr, sequencing_chip, um_per_pixel, fia, side1,
-                               end_tiles, column, possible_tile_keys, h5_filename):
+                               column, possible_tile_keys, h5_filename):
+    # Returns (h5_filename, (tile keys, column)) if an image in this column aligned, otherwise None
+    result = None
+    if _stop_event is not None and _stop_event.is_set():
+        # an earlier column already aligned
+        return result
     base_name = os.path.splitext(h5_filename)[0]
-    with h5py.File(h5_filename) as h5:
+    with open_h5(h5_filename) as h5:
         grid = GridImages(h5, channel)
         # we assume odd numbers of rows, and good enough for now
         if grid.height > 2:
-            center_row = grid.height / 2
+            center_row = grid.height // 2
             rows_to_check = (center_row, center_row + 1, center_row - 1)
         else:
             # just one or two rows, might as well try them all
@@ -282,16 +359,15 @@ def check_column_for_alignment(cluster_strategy, rotation_adjustment, channel, s
                 log.warn("Could not find an image for %s Row %d Column %d" % (base_name, row, column))
                 return
             log.debug("Aligning %s Row %d Column %d against PhiX" % (base_name, row, column))
-            fia = process_alignment_image(cluster_strategy, rotation_adjustment, snr, sequencing_chip, base_name, um_per_pixel, image, possible_tile_keys, deepcopy(fia), side1)
+            fia = process_alignment_image(cluster_strategy, rotation_adjustment, snr, sequencing_chip, base_name, um_per_pixel, image, possible_tile_keys, fia.clone_for_image(), side1)
             if fia.hitting_tiles:
                 log.debug("%s aligned to at least one tile!" % image.index)
                 # because of the way we iterate through the images, if we find one that aligns,
                 # we can just stop because that gives us the outermost column of images and the
                 # outermost FastQ tile
-                end_tiles[h5_filename] = [tile.key for tile in fia.hitting_tiles], image.column
+                result = h5_filename, ([tile.key for tile in fia.hitting_tiles], image.column)
                 break
-    del fia
-    gc.collect()
+    return result
 
 
 def iterate_all_images(h5_filenames, end_tiles, channel, path_info):
@@ -300,43 +376,60 @@ def iterate_all_images(h5_filenames, end_tiles, channel, path_info):
     # to the image itself that allow files to be written in the correct place and such
     for h5_filename in h5_filenames:
         base_name = os.path.splitext(h5_filename)[0]
-        with h5py.File(h5_filename) as h5:
+        # List the results directory once, so checking whether an image was already aligned doesn't
+        # cost several filesystem calls per image
+        results_dir = os.path.join(path_info.results_directory, base_name)
+        existing = set(os.listdir(results_dir)) if os.path.isdir(results_dir) else set()
+        with open_h5(h5_filename) as h5:
             grid = GridImages(h5, channel)
             min_column, max_column, tile_map = end_tiles[h5_filename]
             for column in range(min_column, max_column):
                 for row in range(grid._height):
-                    image = grid.get(row, column)
-                    if image is None:
+                    # The workers read the pixels, so here we only check that the image exists
+                    if not grid.contains(row, column):
+                        log.warn("Missing (Major, minor) = (%d, %d) in %s" % (column, row, channel))
                         continue
-                    stats_path = os.path.join(path_info.results_directory, base_name,
-                                              '{}_stats.txt'.format(image.index))
-                    alignment_path = os.path.join(path_info.results_directory, base_name,
-                                                  '{}_all_read_rcs.txt'.format(image.index))
-                    already_aligned = alignment_is_complete(stats_path) and os.path.exists(alignment_path)
+                    index = image_index(channel, row, column)
+                    stats_filename = '{}_stats.txt'.format(index)
+                    already_aligned = (stats_filename in existing
+                                       and '{}_all_read_rcs.txt'.format(index) in existing
+                                       and alignment_is_complete(os.path.join(results_dir, stats_filename)))
                     if already_aligned:
-                        log.debug("Image already aligned/checkpointed: {}/{}".format(h5_filename, image.index))
+                        log.debug("Image already aligned/checkpointed: {}/{}".format(h5_filename, index))
                         continue
-                    yield row, column, channel, h5_filename, tile_map[image.column], base_name
+                    yield row, column, channel, h5_filename, tile_map[column], base_name
+
+
+def get_figure(figsize):
+    # Returns an empty figure of the given size. These don't go through pyplot, so they're never registered
+    # with its global figure manager and don't have to be closed.
+    figure = _figures.get(figsize)
+    if figure is None:
+        figure = Figure(figsize=figsize)
+        FigureCanvasAgg(figure)
+        _figures[figsize] = figure
+    figure.clear()
+    return figure
 
 
 def load_read_names(file_path):
     if not file_path:
         return {}
-    # reads a FastQ file with Illumina read names
+    # reads a FastQ file with Illumina read names. These files hold tens of millions of reads, so the
+    # per-line work is kept to one strip and one split, and reads are grouped by their (lane, tile)
+    # fields so the tile key only has to be formatted once per tile
+    tiles = defaultdict(set)
     with open(file_path) as f:
-        tiles = defaultdict(set)
         for line in f:
-            try:
-                lane, tile = line.strip().rsplit(':', 4)[1:3]
-            except ValueError:
-                if line.strip():
+            name = line.strip()
+            fields = name.rsplit(':', 4)
+            if len(fields) < 3:
+                if name:
                     log.warn("Invalid line in read file: %s" % file_path)
                     log.warn("The invalid line was: %s" % line)
-            else:
-                key = 'lane{0}tile{1}'.format(lane, tile)
-                tiles[key].add(line.strip())
-    del f
-    return {key: list(values) for key, values in tiles.items()}
+                continue
+            tiles[fields[1], fields[2]].add(name)
+    return {'lane{0}tile{1}'.format(lane, tile): list(values) for (lane, tile), values in tiles.items()}
 
 
 def process_alignment_image(cluster_strategy, rotation_adjustment, snr, sequencing_chip, base_name, um_per_pixel, image, possible_tile_keys, fia, side1):
@@ -389,18 +482,15 @@ def write_output(stats_file_path, image_index, base_name, fastq_image_aligner, p
     # save the corrected location of each read
     all_fastq_image_aligner = fastqimagealigner.FastqImageAligner(um_per_pixel)
     all_fastq_image_aligner.all_reads_fic_from_aligned_fic(fastq_image_aligner, all_tile_data)
-    with open(all_read_rcs_filepath, 'w') as f:
-        for line in all_fastq_image_aligner.read_names_rcs:
-            f.write(line)
+    with open(all_read_rcs_filepath, 'w', 1024 * 1024) as f:
+        f.writelines(all_fastq_image_aligner.read_names_rcs)
 
     # save some diagnostic PDFs that give a nice visualization of the alignment
     if make_pdfs:
-        ax = plotting.plot_all_hits(fastq_image_aligner)
+        ax = plotting.plot_all_hits(fastq_image_aligner, ax=get_figure((15, 15)).add_subplot(111))
         ax.figure.savefig(os.path.join(path_info.figure_directory, base_name, '{}_all_hits.pdf'.format(image_index)))
-        plt.close()
-        ax = plotting.plot_hit_hists(fastq_image_aligner)
+        ax = plotting.plot_hit_hists(fastq_image_aligner, ax=get_figure((8, 8)).add_subplot(111))
         ax.figure.savefig(os.path.join(path_info.figure_directory, base_name, '{}_hit_hists.pdf'.format(image_index)))
-        plt.close()
     del all_fastq_image_aligner
     del fastq_image_aligner
     return True
@@ -1,12 +1,13 @@
 import logging
 import time
-from copy import deepcopy
-from itertools import izip
+from collections import defaultdict
+from copy import copy
+from itertools import izip, repeat
 import numpy as np
 from champ import stats, clusters
 from fastqtilercs import FastqTileRCs
 from imagedata import ImageData
-from scipy.spatial import KDTree
+from scipy.spatial import cKDTree
 
 log = logging.getLogger(__name__)
 
@@ -34,14 +35,30 @@ class FastqImageAligner(object):
         self.good_mutual_hits = set()
         self.exclusive_hits = set()
         self.hitting_tiles = []
+        # The extent of all loaded reads, found the first time it's needed
+        self._rcs_bounds = None
 
     def load_reads(self, tile_data, valid_keys=None):
         # Here we load phiX reads from the mapping result files.
         # We would like to organize the reads by their tiles. 
+        self._rcs_bounds = None
         for tile_key, read_names in tile_data.items():
             if valid_keys is None or tile_key in valid_keys:
                 self.fastq_tiles[tile_key] = FastqTileRCs(tile_key, read_names, self.microns_per_pixel)
 
+    def clone_for_image(self):
+        """
+        Returns an aligner with the same reads, ready to be aligned to a new image. Only per-image state is
+        created anew; the reads themselves never change once loaded, so they are shared rather than copied.
+
+        """
+        fia = FastqImageAligner(self.microns_per_pixel)
+        fia.fastq_tiles = {key: tile.clone() for key, tile in self.fastq_tiles.items()}
+        fia.fastq_tiles_keys = list(self.fastq_tiles_keys)
+        fia.fq_w = self.fq_w
+        fia._rcs_bounds = self._rcs_bounds
+        return fia
+
     @property
     def fastq_tiles_list(self):
         for _, tile in sorted(self.fastq_tiles.items()):
@@ -49,7 +66,8 @@ class FastqImageAligner(object):
 
     def all_reads_fic_from_aligned_fic(self, other_fic, all_reads):
         self.load_reads(all_reads, valid_keys=[tile.key for tile in other_fic.hitting_tiles])
-        self.image_data = deepcopy(other_fic.image_data)
+        # The image and its spectrum are never modified once computed, so they're shared rather than duplicated
+        self.image_data = copy(other_fic.image_data)
         self.fq_w = other_fic.fq_w
         self.set_fastq_tile_mappings()
         self.set_all_fastq_image_data()
@@ -80,8 +98,21 @@ class FastqImageAligner(object):
         self.hitting_tiles = []
         with open(path) as f:
             astats = stats.AlignmentStats().from_file(f)
-        for tile_key, scaling, tile_width, rotation, rc_offset, _ in astats:
-            self.set_tile_alignment(tile_key, scaling, tile_width, rotation, rc_offset)
+        tile_alignments = list(astats)
+        if not tile_alignments:
+            return
+        # The tile mappings only depend on the tile width, so they're computed once up front rather than once per
+        # tile. Recomputing them would also reset the transforms of the tiles that were already aligned.
+        self.fq_w = tile_alignments[-1][2]
+        self.set_fastq_tile_mappings()
+        self.set_all_fastq_image_data()
+        hitting_tile_keys = set()
+        for tile_key, scaling, tile_width, rotation, rc_offset, _ in tile_alignments:
+            tile = self.fastq_tiles[tile_key]
+            if tile_key not in hitting_tile_keys:
+                hitting_tile_keys.add(tile_key)
+                self.hitting_tiles.append(tile)
+            tile.set_aligned_rcs_given_transform(scaling, rotation, rc_offset)
 
     def set_sexcat_from_file(self, fpath, cluster_strategy):
         with open(fpath) as f:
@@ -98,9 +129,9 @@ class FastqImageAligner(object):
                                       self.fq_w)
 
     def rotate_all_fastq_data(self, degrees):
-        im_shapes = [tile.rotate_data(degrees) for tile in self.fastq_tiles_list]
-        self.fq_im_scaled_dims = np.array(im_shapes).max(axis=0)
-        for tile in self.fastq_tiles_list:
+        tiles = tuple(self.fastq_tiles_list)
+        self.fq_im_scaled_dims = np.maximum.reduce([tile.rotate_data(degrees) for tile in tiles])
+        for tile in tiles:
             tile.image_shape = self.fq_im_scaled_dims
 
     def set_fastq_tile_mappings(self):
@@ -112,10 +143,13 @@ class FastqImageAligner(object):
         assert self.image_data is not None, 'No image data loaded.'
         assert self.fastq_tiles != {}, 'No fastq data loaded.'
 
-        all_data = np.concatenate([tile.rcs for key, tile in self.fastq_tiles.items()])
-
-        x_min, y_min = all_data.min(axis=0)
-        x_max, y_max = all_data.max(axis=0)
+        # Each tile already knows the extent of its reads, so there's no need to scan all of them again. The result
+        # only changes when reads are loaded.
+        if self._rcs_bounds is None:
+            tiles = self.fastq_tiles.values()
+            self._rcs_bounds = (np.minimum.reduce([tile.rcs_min for tile in tiles]),
+                                np.maximum.reduce([tile.rcs_max for tile in tiles]))
+        (x_min, y_min), (x_max, y_max) = self._rcs_bounds
 
         self.fq_im_offset = np.array([-x_min, -y_min])
         # The scaling factor to transform from FASTQ coordinate system to microscope imaging coordinate system is computed by,
@@ -142,7 +176,8 @@ class FastqImageAligner(object):
         # For the rough alignment, possible tiles are the half of the chip range.
         # The impossible tiles are simply the other half of the chip range. It is useful when computing the control alignment noise.
         ### ----------------------
-        impossible_tiles = [tile for tile in self.fastq_tiles.values() if tile not in possible_tiles]
+        possible_tile_set = set(possible_tiles)
+        impossible_tiles = [tile for tile in self.fastq_tiles.values() if tile not in possible_tile_set]
         impossible_tiles.sort(key=lambda tile: -len(tile.read_names))
         # Two control tiles having more reads are selected.
         control_tiles = impossible_tiles[:2]
@@ -150,14 +185,6 @@ class FastqImageAligner(object):
         self.image_data.set_fft(self.fq_im_scaled_dims)
         self.control_corr = 0
 
-        
-        # Here we would like to link the tile number to its key so that we can print it later.
-        tile_num = {}
-        key_to_use = floor_possible_tile_keys if side1 else possible_tile_keys
-        for key in keys_to_use:
-            if self.fastq_tiles.get(key) in possible_tiles:
-                tile_num[self.fastq_tiles.get(key)] = key
-
         for control_tile in control_tiles:
             ### ----------------------
             # Here we perform FFT of control tiles and compute the cross-correlation value between TIFF images and the FASTQ tiles after FFT.
@@ -176,7 +203,6 @@ class FastqImageAligner(object):
             # If the max_corr passes the product of SNR and the control_corr, then it is considered as a successful rough alignment.
             # The tile number will then be documented as a hitting tile.
             ### ----------------------
-            
             max_corr, align_tr = tile.fft_align_with_im(self.image_data)
             if max_corr > snr_thresh * self.control_corr:
                 tile.set_aligned_rcs(align_tr)
@@ -184,7 +210,7 @@ class FastqImageAligner(object):
                 self.hitting_tiles.append(tile)
 
             # Display the in-process alignment information.
-            log.debug('tile# = {}, SNR = {}, control_corr = {}, max_corr = {}'.format(tile_num[tile], round(max_corr/self.control_corr, 2), round(self.control_corr, 2), round(max_corr, 2)))
+            log.debug('tile# = {}, SNR = {}, control_corr = {}, max_corr = {}'.format(tile.key, round(max_corr/self.control_corr, 2), round(self.control_corr, 2), round(max_corr, 2)))
 
     def find_points_in_frame(self, consider_tiles='all'):
         ### ----------------------
@@ -192,7 +218,8 @@ class FastqImageAligner(object):
         # To estimate the points within the FOV, we first compute the X, Y coordinates of each read after transformation (i.e., scaling, rotation, etc.)
         # If the X, Y coordiantes of a read fall within the FOV size, we consider it as a aligned_rcs_in_frame.
         ### ----------------------
-        self.rcs_in_frame = []
+        rcs_in_frame = []
+        rcs_in_frame_tile_keys = []
         aligned_rcs_in_frame = []
         im_shape = self.image_data.image.shape
         # Consider tiles are the tiles pass the SNR criteria.
@@ -202,16 +229,31 @@ class FastqImageAligner(object):
             considered_tiles = [consider_tiles]
 
         for tile in considered_tiles:
-            rcs = tile.rcs.astype(np.int)
-            for i, pt in enumerate(tile.aligned_rcs):
-                if 0 <= pt[0] < im_shape[0] and 0 <= pt[1] < im_shape[1]:
-                    aligned_rcs_in_frame.append(pt)
-                    self.rcs_in_frame.append((tile.key, rcs[i]))
-        self.aligned_rcs_in_frame = np.array(aligned_rcs_in_frame)
+            aligned_rcs = tile.aligned_rcs
+            in_frame = ((aligned_rcs[:, 0] >= 0) & (aligned_rcs[:, 0] < im_shape[0])
+                        & (aligned_rcs[:, 1] >= 0) & (aligned_rcs[:, 1] < im_shape[1]))
+            aligned_rcs_in_frame.append(aligned_rcs[in_frame])
+            rcs_in_frame.append(tile.rcs[in_frame].astype(np.int))
+            rcs_in_frame_tile_keys.extend(repeat(tile.key, len(rcs_in_frame[-1])))
+        # The read coordinates and the keys of their tiles are kept as parallel arrays, so all the reads of a set of
+        # hits can be gathered with a single index.
+        if aligned_rcs_in_frame:
+            self.aligned_rcs_in_frame = np.concatenate(aligned_rcs_in_frame)
+            self.rcs_in_frame_arr = np.concatenate(rcs_in_frame)
+        else:
+            self.aligned_rcs_in_frame = np.zeros((0, 2))
+            self.rcs_in_frame_arr = np.zeros((0, 2), dtype=np.int)
+        self.rcs_in_frame_tile_keys = np.array(rcs_in_frame_tile_keys, dtype=object)
+
+    @property
+    def rcs_in_frame(self):
+        return zip(self.rcs_in_frame_tile_keys, self.rcs_in_frame_arr)
 
     def hit_dists(self, hits):
-        # Here we estimate the euclidean distance between two points.
-        return [self.single_hit_dist(hit) for hit in hits]
+        # Here we estimate the euclidean distance between two points, for all hits at once.
+        hits = np.array(list(hits), dtype=np.intp).reshape(-1, 2)
+        diff = self.clusters.point_rcs[hits[:, 0]] - self.aligned_rcs_in_frame[hits[:, 1]]
+        return np.sqrt(np.einsum('ij,ij->i', diff, diff))
 
     def single_hit_dist(self, hit):
         # This method is called when we want to estimate two points distance during the precision alignment stage. One in FASTQ space and one in TIFF space.
@@ -223,7 +265,7 @@ class FastqImageAligner(object):
             return []
         dists = self.hit_dists(hits)
         thresh = np.percentile(dists, pct_thresh * 100)
-        return [hit for hit in hits if self.single_hit_dist(hit) <= thresh]
+        return [hit for hit, dist in izip(hits, dists) if dist <= thresh]
 
     def find_hits(self, consider_tiles='all'):
         ### --------------------------------------------------------------------------------
@@ -233,21 +275,21 @@ class FastqImageAligner(object):
         # The aligned_tree is the tree for FASTQ coordinates. We only consider the FASTQ reads within the FOV.
         ### --------------------------------------------------------------------------------
         self.find_points_in_frame(consider_tiles)
-        cluster_tree = KDTree(self.clusters.point_rcs)
-        aligned_tree = KDTree(self.aligned_rcs_in_frame)
-
-        # All indices are in the order (cluster_index, aligned_in_frame_idx)
-        cluster_to_aligned_indexes = set()
-        for i, pt in enumerate(self.clusters.point_rcs):
-            # Providing the TIFF cluster centroids, we want to know what is the closest FASTQ reads in the FASTQ space.
-            dist, idx = aligned_tree.query(pt)
-            cluster_to_aligned_indexes.add((i, idx))
-
-        aligned_to_cluster_indexs_rev = set()
-        for i, pt in enumerate(self.aligned_rcs_in_frame):
-            # In contrast, providing the FASTQ read coordinates, we want to know what is the closest TIFF cluster centroid in the TIFF space.
-            dist, idx = cluster_tree.query(pt)
-            aligned_to_cluster_indexs_rev.add((idx, i))
+        cluster_tree = cKDTree(self.clusters.point_rcs)
+        aligned_tree = cKDTree(self.aligned_rcs_in_frame)
+
+        # All indices are in the order (cluster_index, aligned_in_frame_idx). While the hits are being sorted into
+        # groups, each pair is encoded as the single integer cluster_index * num_aligned + aligned_in_frame_idx,
+        # so the set operations below run on sorted NumPy arrays. They're decoded back to sets of tuples at the end.
+        num_aligned = len(self.aligned_rcs_in_frame)
+        # Providing the TIFF cluster centroids, we want to know what is the closest FASTQ reads in the FASTQ space.
+        # Every point is queried at once, so the search runs entirely in C.
+        _, aligned_idxs = aligned_tree.query(self.clusters.point_rcs)
+        cluster_to_aligned_indexes = np.arange(len(aligned_idxs), dtype=np.int64) * num_aligned + aligned_idxs
+
+        # In contrast, providing the FASTQ read coordinates, we want to know what is the closest TIFF cluster centroid in the TIFF space.
+        _, cluster_idxs = cluster_tree.query(self.aligned_rcs_in_frame)
+        aligned_to_cluster_indexs_rev = cluster_idxs.astype(np.int64) * num_aligned + np.arange(num_aligned)
 
         ### --------------------------------------------------------------------------------
         # Here we categorize hits into different groups. For the precision alignment to success, the number of exclusive_hits + good_mutual_hits should pass the user-defined threshold (i.e., --min-hits).
@@ -257,13 +299,18 @@ class FastqImageAligner(object):
         # (4) good_mutual_hits: If A and B are mutual_hits but not exclusive, which means that there is either C or D, or both, consider A or B as the closest neighbor. However, the distance between the other candidate is longer than the threshold. Then A and B belong to this category.
         # (5) bad_mutual_hits: If A and B are mutual_hits but not exclusive, neither good mutual. 
         ### --------------------------------------------------------------------------------
-        mutual_hits = cluster_to_aligned_indexes & aligned_to_cluster_indexs_rev # Find the common closest neighbor pairs between the two groups.
-        non_mutual_hits = cluster_to_aligned_indexes ^ aligned_to_cluster_indexs_rev # Find the different closest neighbor pairs.
+        mutual_hits = np.intersect1d(cluster_to_aligned_indexes, aligned_to_cluster_indexs_rev, assume_unique=True) # Find the common closest neighbor pairs between the two groups.
+        non_mutual_hits = np.setxor1d(cluster_to_aligned_indexes, aligned_to_cluster_indexs_rev, assume_unique=True) # Find the different closest neighbor pairs.
+
+        cluster_in_non_mutual = non_mutual_hits // num_aligned # Identify the TIFF clusters having more than one closest neighbor by FASTQ reads.
+        aligned_in_non_mutual = non_mutual_hits % num_aligned # Identify the FASTQ reads having more than one closest neighbor by TIFF clusters.
+        exclusive_hits = mutual_hits[~np.in1d(mutual_hits // num_aligned, cluster_in_non_mutual)
+                                     & ~np.in1d(mutual_hits % num_aligned, aligned_in_non_mutual)]
 
-        cluster_in_non_mutual = set(i for i, j in non_mutual_hits) # Identify the TIFF clusters having more than one closest neighbor by FASTQ reads.
-        aligned_in_non_mutual = set(j for i, j in non_mutual_hits) # Identify the FASTQ reads having more than one closest neighbor by TIFF clusters.
-        exclusive_hits = set((i, j) for i, j in mutual_hits if i not in
-                             cluster_in_non_mutual and j not in aligned_in_non_mutual)
+        all_hits = decode_hits(np.union1d(cluster_to_aligned_indexes, aligned_to_cluster_indexs_rev), num_aligned)
+        mutual_hits = decode_hits(mutual_hits, num_aligned)
+        non_mutual_hits = decode_hits(non_mutual_hits, num_aligned)
+        exclusive_hits = decode_hits(exclusive_hits, num_aligned)
 
         # --------------------------------------------------------------------------------
         # Recover good non-exclusive mutual hits. 
@@ -278,8 +325,9 @@ class FastqImageAligner(object):
             good_hit_threshold = np.percentile(self.hit_dists(exclusive_hits), 95)
         second_neighbor_thresh = 2 * good_hit_threshold
         # To be more conservative, we limit the hits that can be classified as a exclusive_hits by considering only the hit pair closer than the good_hit_threshold.
-        exclusive_hits = set(hit for hit in exclusive_hits
-                             if self.single_hit_dist(hit) <= good_hit_threshold)
+        exclusive_hits = list(exclusive_hits)
+        exclusive_hits = set(hit for hit, dist in izip(exclusive_hits, self.hit_dists(exclusive_hits))
+                             if dist <= good_hit_threshold)
         
         # --------------------------------------------------------------------------------
         # Here we would like to classify the hits to be good_mutual_hits.
@@ -288,12 +336,22 @@ class FastqImageAligner(object):
         # Next, take C and A as a candidate pair as an example. If the distance between A and C is longer than the second_neighbor_thresh, then A and B can be consider as good_mutual_hits.
         # In contrast, if the distance between C and A is closer than second_neighbor_thresh, A and B will not be consider as good_mutual_hits.
         # --------------------------------------------------------------------------------
+        # The non-mutual hits are indexed by cluster and by read, and every distance needed is computed up front,
+        # so each candidate only costs a few lookups instead of a scan over all non-mutual hits.
+        third_wheels_by_cluster = defaultdict(list)
+        third_wheels_by_read = defaultdict(list)
+        for hit in non_mutual_hits:
+            third_wheels_by_cluster[hit[0]].append(hit)
+            third_wheels_by_read[hit[1]].append(hit)
+        candidate_hits = mutual_hits - exclusive_hits
+        measured_hits = list(candidate_hits | non_mutual_hits)
+        dist_of = dict(izip(measured_hits, self.hit_dists(measured_hits).tolist()))
         good_mutual_hits = set()
-        for i, j in (mutual_hits - exclusive_hits):
-            if self.hit_dists([(i, j)])[0] > good_hit_threshold:
+        for i, j in candidate_hits:
+            if dist_of[(i, j)] > good_hit_threshold:
                 continue
-            third_wheels = [tup for tup in non_mutual_hits if i == tup[0] or j == tup[1]]
-            if min(self.hit_dists(third_wheels)) > second_neighbor_thresh:
+            third_wheels = third_wheels_by_cluster[i] + third_wheels_by_read[j]
+            if min(dist_of[hit] for hit in third_wheels) > second_neighbor_thresh:
                 good_mutual_hits.add((i, j))
         # For all other mutual hit pairs that are not exclusive_hits neither good_mutual_hits, they will be classified as bad_mutual_hits.
         bad_mutual_hits = mutual_hits - exclusive_hits - good_mutual_hits
@@ -301,11 +359,10 @@ class FastqImageAligner(object):
         # --------------------------------------------------------------------------------
         # Test that the four groups form a partition of all hits and finalize
         # --------------------------------------------------------------------------------
-        assert (non_mutual_hits | bad_mutual_hits | good_mutual_hits | exclusive_hits
-                == cluster_to_aligned_indexes | aligned_to_cluster_indexs_rev
+        assert (non_mutual_hits | bad_mutual_hits | good_mutual_hits | exclusive_hits == all_hits
                 and len(non_mutual_hits) + len(bad_mutual_hits)
                 + len(good_mutual_hits) + len(exclusive_hits)
-                == len(cluster_to_aligned_indexes | aligned_to_cluster_indexs_rev))
+                == len(all_hits))
 
         self.non_mutual_hits = non_mutual_hits
         self.mutual_hits = mutual_hits
@@ -376,21 +433,22 @@ class FastqImageAligner(object):
             else:
             # If the number of hits is larger than the user-defined threshold, consider this tile.
                 found_good_mapping = True
-            A = np.zeros((2 * len(hits), 4))
-            b = np.zeros((2 * len(hits),))
-            for i, (cluster_index, in_frame_idx) in enumerate(hits):
-                # Extract the adjusted TIFF cluster x, y coordinates in the FOV.
-                tile_key, (xir, yir) = self.rcs_in_frame[in_frame_idx]
-                A[2*i, :] = [xir, -yir, 1, 0]
-                A[2*i+1, :] = [yir,  xir, 0, 1]
-                
-                # Extract the adjusted phiX x, y coordinates in the FOV.
-                xis, yis = self.clusters.point_rcs[cluster_index]
-                b[2*i] = xis
-                b[2*i+1] = yis
-
-            alpha, beta, x_offset, y_offset = np.linalg.lstsq(A, b)[0]
-            offset = np.array([x_offset, y_offset])
+            hits = np.array(hits, dtype=np.intp)
+            # Extract the adjusted TIFF cluster x, y coordinates in the FOV.
+            rcs = self.rcs_in_frame_arr[hits[:, 1]].astype(np.float64)
+            # Extract the adjusted phiX x, y coordinates in the FOV.
+            points = self.clusters.point_rcs[hits[:, 0]].astype(np.float64)
+
+            # Ax = b is a 2D similarity fit, which has a closed-form solution: once both point sets are centered,
+            # alpha and beta come from their dot and cross products, and the offset maps one centroid onto the other.
+            rcs_center = rcs.mean(axis=0)
+            points_center = points.mean(axis=0)
+            d_rcs = rcs - rcs_center
+            d_points = points - points_center
+            norm = np.einsum('ij,ij->', d_rcs, d_rcs)
+            alpha = np.einsum('ij,ij->', d_rcs, d_points) / norm
+            beta = (d_rcs[:, 0] * d_points[:, 1] - d_rcs[:, 1] * d_points[:, 0]).sum() / norm
+            offset = points_center - np.array([[alpha, -beta], [beta, alpha]]).dot(rcs_center)
             theta = np.arctan2(beta, alpha)
             lbda = alpha / np.cos(theta)
             tile.set_aligned_rcs_given_transform(lbda, theta, offset)
@@ -447,3 +505,8 @@ class FastqImageAligner(object):
             for read_name, pt in izip(tile.read_names, tile.aligned_rcs):
                 if 0 <= pt[0] < im_shape[0] and 0 <= pt[1] < im_shape[1]:
                     yield '%s\t%f\t%f\n' % (read_name, pt[0], pt[1])
+
+
+def decode_hits(keys, num_aligned):
+    # Converts hits encoded as cluster_index * num_aligned + aligned_in_frame_idx back into a set of index pairs
+    return set(izip((keys // num_aligned).tolist(), (keys % num_aligned).tolist()))
@@ -9,11 +9,33 @@ log = logging.getLogger(__name__)
 
 class FastqTileRCs(object):
     """A class for fastq tile coordinates."""
-    def __init__(self, key, read_names, microns_per_pixel):
+    def __init__(self, key, read_names, microns_per_pixel, rcs=None, rcs_bounds=None):
         self.key = key
         self.microns_per_pixel = microns_per_pixel
         self.read_names = read_names
-        self.rcs = np.array([map(int, name.split(':')[-2:]) for name in self.read_names])
+        if rcs is None:
+            rcs = np.array([map(int, name.split(':')[-2:]) for name in self.read_names])
+        self.rcs = rcs
+        if rcs_bounds is None:
+            rcs_bounds = rcs.min(axis=0), rcs.max(axis=0)
+        # The extent of the reads is needed for every image, so it's only found once
+        self.rcs_min, self.rcs_max = rcs_bounds
+
+    def clone(self):
+        """Returns a tile without any alignment data. The read names and their coordinates are shared, not copied."""
+        return FastqTileRCs(self.key, self.read_names, self.microns_per_pixel, rcs=self.rcs,
+                            rcs_bounds=(self.rcs_min, self.rcs_max))
+
+    def __deepcopy__(self, memo):
+        # The read names and their coordinates never change once loaded, so copies of a tile (and of any
+        # aligner holding it) share them instead of duplicating every read
+        memo[id(self.read_names)] = self.read_names
+        memo[id(self.rcs)] = self.rcs
+        tile = FastqTileRCs.__new__(FastqTileRCs)
+        memo[id(self)] = tile
+        for name, value in self.__dict__.items():
+            setattr(tile, name, deepcopy(value, memo))
+        return tile
 
     def set_fastq_image_data(self, offset, scale, scaled_dims, width):
         self.offset = offset
@@ -42,8 +64,10 @@ class FastqTileRCs(object):
     def fft_align_with_im(self, image_data):
         # Make the ffts
         fq_image = self.image()
-        padded_fq_im = misc.pad_to_size(fq_image, image_data.fft.shape)
-        fq_im_fft = np.fft.fft2(padded_fq_im)
+        if fq_image.shape[0] > image_data.fft_shape[0] or fq_image.shape[1] > image_data.fft_shape[1]:
+            raise ValueError("Tile image (%dx%d) is larger than the padded microscope image (%dx%d)!" % (fq_image.shape + image_data.fft_shape))
+        # Let the FFT zero-pad the tile image itself. Its first pass then only runs over the rows that hold data.
+        fq_im_fft = np.fft.rfft2(fq_image, s=image_data.fft_shape)
         # Align
         im_data_fft = image_data.fft
         if im_data_fft.shape != fq_im_fft.shape:
@@ -51,10 +75,16 @@ class FastqTileRCs(object):
                                                                                                              im_data_fft.shape[1],
                                                                                                              fq_im_fft.shape[0],
                                                                                                              fq_im_fft.shape[1]))
-        cross_corr = abs(np.fft.ifft2(np.conj(fq_im_fft) * im_data_fft))
-        max_corr = cross_corr.max()
-        max_idx = misc.max_2d_idx(cross_corr)
-        align_tr = np.array(max_idx) - fq_image.shape
+        # The product overwrites the tile's spectrum and the magnitude overwrites the correlation, so no full-size
+        # temporaries are allocated
+        np.conjugate(fq_im_fft, out=fq_im_fft)
+        fq_im_fft *= im_data_fft
+        cross_corr = np.fft.irfft2(fq_im_fft, s=image_data.fft_shape)
+        np.absolute(cross_corr, out=cross_corr)
+        # One pass over the correlation finds the peak's position, and its value is read from there
+        peak = cross_corr.argmax()
+        max_corr = cross_corr.flat[peak]
+        align_tr = np.array(np.unravel_index(peak, cross_corr.shape)) - fq_image.shape
         return max_corr, align_tr
 
     def set_aligned_rcs(self, align_tr):
@@ -5,6 +5,10 @@ import numpy as np
 log = logging.getLogger(__name__)
 
 
+def image_index(channel, row, column):
+    return "%s_%.3d_%.3d" % (channel, row, column)
+
+
 class Image(np.ndarray):
     """
     Holds the raw pixel data of an image and provides access to some metadata.
@@ -20,7 +24,7 @@ class Image(np.ndarray):
 
     @property
     def index(self):
-        return "%s_%.3d_%.3d" % (self.channel, self.row, self.column)
+        return image_index(self.channel, self.row, self.column)
 
     def __array_wrap__(self, obj, *_):
         if len(obj.shape) == 0:
@@ -61,7 +65,15 @@ class GridImages(object):
 
     def __len__(self):
         # The number of images in this channel
-        return len(self._h5[self._channel])
+        return GridImages.count_only(self._h5, self._channel)
+
+    @staticmethod
+    def count_only(h5, channel):
+        """
+        Counts the images in a channel using only the group's metadata, without parsing the grid.
+
+        """
+        return len(h5[channel])
 
     @property
     def height(self):
@@ -98,6 +110,13 @@ class GridImages(object):
                 if image is not None:
                     yield image
 
+    def contains(self, row, column):
+        """
+        Checks whether an image exists without reading its pixels.
+
+        """
+        return '(Major, minor) = (%d, %d)' % (column, row) in self._h5[self._channel]
+
     def get(self, row, column):
         try:
             raw_array = self._h5[self._channel]['(Major, minor) = (%d, %d)' % (column, row)].value
@@ -1,5 +1,5 @@
 import numpy as np
-from champ import misc
+from scipy.fftpack import next_fast_len
 
 
 class ImageData(object):
@@ -8,25 +8,32 @@ class ImageData(object):
         assert isinstance(image, np.ndarray), 'Image not numpy ndarray'
         self.fname = str(filename)
         self.fft = None
+        self.fft_shape = None
         self.image = image
         self.median_normalize()
         self.um_per_pixel = um_per_pixel
         self.um_dims = self.um_per_pixel * np.array(self.image.shape)
 
     def median_normalize(self):
-        med = np.median(self.image)
-        self.image = self.image.astype('float', copy=False, casting='safe')
-        self.image /= float(med)
+        # The median of an evenly strided sample of about 200k pixels is as good a normalization constant as that
+        # of the whole image. The sample is its own copy, so median() may partition it in place.
+        flat = self.image.ravel()
+        sample = flat[::max(1, flat.size // 200000)].copy()
+        med = np.median(sample, overwrite_input=True)
+        # Single precision is plenty for picking correlation peaks and halves the memory the image takes up. Casting
+        # inside the divide converts and scales the image in the same pass. The images from champ h5 are int64, which
+        # can't be cast to float32 without rounding, so the cast has to allow it.
+        self.image = np.divide(self.image, np.float32(med), dtype=np.float32, casting='same_kind')
         self.image -= 1.0
 
-    # Perform FFT on the TIFF images. Since the cross-correlation computation is more efficient when matrices size is power of 2. We pad constant 0 to the original TIFF image to fulfill this requirement. 
+    # Perform FFT on the TIFF images. We pad constant 0 around the original TIFF image so the cross-correlation with each
+    # tile doesn't wrap around, and round each dimension up to a size the FFT handles efficiently.
     def set_fft(self, padding):
         totalx, totaly = np.array(padding) + np.array(self.image.shape)
-        dimension = int(max(misc.next_power_of_2(totalx),
-                        misc.next_power_of_2(totaly))) # Call the "next_power_of_2" method in the misc.py file to calculate the dimension needed to fit in the TIFF images.
+        dim0, dim1 = next_fast_len(int(totalx)), next_fast_len(int(totaly))
         padded_im = np.pad(self.image,
-                           ((int(padding[0]), dimension - int(totalx)), (int(padding[1]), dimension - int(totaly))),
+                           ((int(padding[0]), dim0 - int(totalx)), (int(padding[1]), dim1 - int(totaly))),
                            mode='constant')
-        if padded_im.shape != (dimension, dimension):
-            raise ValueError("FFT of microscope image is not a power of 2, this will cause the program to stall.")
-        self.fft = np.fft.fft2(padded_im)
\ No newline at end of file
+        # The image is real, so only half of its spectrum is needed
+        self.fft_shape = padded_im.shape
+        self.fft = np.fft.rfft2(padded_im).astype(np.complex64)
@@ -1,6 +1,7 @@
 import matplotlib.pyplot as plt
 import numpy as np
 from matplotlib.lines import Line2D
+from matplotlib.collections import LineCollection
 from matplotlib.patches import Ellipse
 from matplotlib import gridspec
 import matplotlib as mpl
@@ -269,7 +270,7 @@ def plot_hit_hists(fia, ax=None):
     non_mut_dists = fia.hit_dists(fia.non_mutual_hits)
     bins = np.linspace(0, max(non_mut_dists), 50)
 
-    if non_mut_dists:
+    if len(non_mut_dists):
         ax.hist(non_mut_dists, bins, label='Non-mutual hits', normed=True, histtype='step')
     if fia.bad_mutual_hits:
         ax.hist(fia.hit_dists(fia.bad_mutual_hits), bins,
@@ -286,11 +287,13 @@ def plot_hit_hists(fia, ax=None):
 
 
 def plot_hits(fia, hits, color, ax, kwargs={}):
-    """ Draws circles where hits are located. """
-    for i, j in hits:
-        ax.plot([fia.clusters.point_rcs[i, 1], fia.aligned_rcs_in_frame[j, 1]],
-                [fia.clusters.point_rcs[i, 0], fia.aligned_rcs_in_frame[j, 0]],
-                color=color, **kwargs)
+    """ Draws lines between each cluster and the read it was matched with. """
+    if not len(hits):
+        return ax
+    i, j = np.array(list(hits)).T
+    # one collection draws much faster than a separate line per hit
+    segments = np.stack((fia.clusters.point_rcs[i][:, ::-1], fia.aligned_rcs_in_frame[j][:, ::-1]), axis=1)
+    ax.add_collection(LineCollection(segments, colors=color, **kwargs))
     return ax
 
 
@@ -304,13 +307,14 @@ def plot_ellipses(fia, ax, alpha=1.0, color=(1, 0, 0)):
 
 
 def plot_all_hits(fia, im_kwargs={}, line_kwargs={}, fqpt_kwargs={}, sext_kwargs={},
-                 title_kwargs={}, legend_kwargs={}):
+                 title_kwargs={}, legend_kwargs={}, ax=None):
     """ 
     Creates a plot of a field of view with the raw microscope image in the background and 
     hit locations drawn over them. Provides a very obvious measure of whether the alignment worked or not. 
     
     """
-    fig, ax = plt.subplots(figsize=(15, 15))
+    if ax is None:
+        fig, ax = plt.subplots(figsize=(15, 15))
 
     kwargs = {'cmap': plt.get_cmap('Blues')}
     kwargs.update(im_kwargs)
@@ -1,20 +1,44 @@
-from Bio import SeqIO
-from champ.adapters_cython import simple_hamming_distance
-from collections import defaultdict
+import bisect
+from champ.adapters_cython import find_adapter_positions, unique_overlap_length
+from collections import defaultdict, namedtuple
+from distutils.spawn import find_executable
 import editdistance
+import functools
+import gc
 import gzip
+import io
 import itertools
 import logging
+import marshal
+import multiprocessing
 import numpy as np
 import os
 import pickle
 import pysam
-import random
+import Queue
+import string
 import subprocess
+import sys
+import tempfile
+import threading
 import yaml
 
 log = logging.getLogger(__name__)
 
+# Maps the ASCII value of each base to its index in the log_p table. Anything that isn't A, C, G or T maps to 4.
+BASE_CODES = np.full(256, 4, dtype=np.intp)
+for code, base in enumerate('ACGT'):
+    BASE_CODES[ord(base)] = code
+# Complements DNA bases, including the ambiguous ones, the same way Bio.Seq does
+COMPLEMENT = string.maketrans('ACGTMRWSYKVHDBNacgtmrwsykvhdbn', 'TGCAKYWSRMBDHVNtgcakywsrmbdhvn')
+# How many read pairs classify_seqs works on at once
+CLASSIFY_BATCH_SIZE = 10000
+# The function that decides which reads are kept. It's usually a lambda, which can't be pickled, so it's set in the
+# parent before the pool is created and the forked workers inherit it.
+_usable_read = None
+# A read from a FastQ file. qualities is the Phred+33 encoded quality string.
+FastqRecord = namedtuple('FastqRecord', ['id', 'seq', 'qualities'])
+
 
 def main(clargs):
     """
@@ -24,7 +48,9 @@ def main(clargs):
     quality scores for each base, so we have to decide which is most likely to be correct.
 
     """
-    fastq_filenames = [os.path.join(clargs.fastq_directory, directory) for directory in os.listdir(clargs.fastq_directory)]
+    # Only the names that could be FastQ files are turned into paths. FastqFiles does the rest of the filtering.
+    fastq_filenames = [os.path.join(clargs.fastq_directory, filename)
+                       for filename in os.listdir(clargs.fastq_directory) if filename.endswith('fastq.gz')]
     fastq_files = FastqFiles(fastq_filenames)
     read_names_given_seq = {}
     if clargs.include_side_1:
@@ -35,22 +61,14 @@ def main(clargs):
     if clargs.log_p_file_path:
         # We need to find the sequence of each read name
         log.debug("Determining probable sequence of each read name.")
-        with open(clargs.log_p_file_path) as f:
-            log_p_struct = pickle.load(f)
-
-        read_names_given_seq = determine_sequences_of_read_names(clargs.min_len, clargs.max_len, log_p_struct, fastq_files, usable_read)
+        log_p_table = load_log_p_table(clargs.log_p_file_path)
+        read_names_given_seq = determine_sequences_of_read_names(clargs.min_len, clargs.max_len, log_p_table, fastq_files, usable_read)
         write_read_names_by_sequence(read_names_given_seq, os.path.join(clargs.output_directory, 'read_names_by_seq.txt'))
 
     if not read_names_given_seq:
         # We already generated read names by seq in a previous run and aren't recreating them this time,
         # so we need to load them from disk
-        with open(os.path.join(clargs.output_directory, "read_names_by_seq.txt")) as f:
-            read_names_given_seq = {}
-            for line in f:
-                line = line.split("\t")
-                seq = line[0]
-                read_names = line[1:]
-                read_names_given_seq[seq] = read_names
+        read_names_given_seq = load_read_names_by_sequence(os.path.join(clargs.output_directory, "read_names_by_seq.txt"))
 
     if clargs.target_sequence_file:
         # Find read names for each target
@@ -82,6 +100,8 @@ class FastqFiles(object):
     """ Sorts compressed FastQ files provided to us from the Illumina sequencer. """
     def __init__(self, filenames):
         self._filenames = list(self._filter_names(filenames))
+        # Used to look up the partner of each file, while _filenames keeps the order they're iterated in
+        self._filename_set = set(self._filenames)
 
     def __iter__(self):
         for f in self._filenames:
@@ -120,9 +140,9 @@ class FastqFiles(object):
         for filename in self._filenames:
             if '_R1_' in filename or '_R1.' in filename:
                 pair = filename.replace('_R1_', '_R2_').replace('_R1.', '_R2.')
-                if paired and pair in self._filenames:
+                if paired and pair in self._filename_set:
                     yield filename, pair
-                elif not paired and pair not in self._filenames:
+                elif not paired and pair not in self._filename_set:
                     yield filename
 
 
@@ -130,46 +150,41 @@ class FastqReadClassifier(object):
     def __init__(self, bowtie_path):
         clean_path = bowtie_path.rstrip(os.path.sep)
         self.name = os.path.basename(clean_path)
-        # Formulate part of the bowtie2 command to align pair-end fastq reads to chimp.sam
-        self._common_command = ('bowtie2', '--local', '-p 15', '--no-unal', '-x %s' % clean_path)
-        
-        # Define variable "home_path", so that we can save files to user-defined home_path. We are not able to save into the docker image since it is a read-only file.
-        self.home_path = os.environ['HOME']
+        # Formulate part of the bowtie2 command to align reads. With no -S option, bowtie2 writes the SAM records to
+        # stdout, so nothing has to be saved to disk (which also matters in the docker image, since it's read-only).
+        self._common_command = ['bowtie2', '--local', '-p', '15', '--no-unal', '-x', clean_path]
 
     def paired_call(self, fastq_file_1, fastq_file_2):
-        # Pass in the pair-end reads fastq files and output as a chimp.sam
-        command = self._common_command + ('-1 ' + fastq_file_1,
-                                          '-2 ' + fastq_file_2,
-                                          '-S ' + os.path.join(self.home_path, 'chimp.sam'),
-                                          '2>&1 | tee ' + os.path.join(self.home_path, 'error.txt')) # Output a error.txt file containing info about the sequence mapping results
+        # Pass in the pair-end reads fastq files
+        command = self._common_command + ['-1', fastq_file_1, '-2', fastq_file_2]
         return self._run(command)
 
     def single_call(self, fastq_file):
-        command = self._common_command + ('-U ' + fastq_file,)
+        command = self._common_command + ['-U', fastq_file]
         return self._run(command)
 
     def _run(self, command):
-        with open('/dev/null', 'w+') as devnull:
-            shell_options = dict(shell=True, stderr=devnull, stdout=devnull)
-            subprocess.call(' '.join(command), **shell_options)
-                                          
-            # Predefine variables that are used for following process
-            chimp = os.path.join(self.home_path, 'chimp.sam')
-            final = os.path.join(self.home_path, 'final.bam')
-            error = os.path.join(self.home_path, 'error.txt')
-            final_bai = os.path.join(self.home_path, 'final.bam.bai')
-            # Samtools first convert the SAM file into a BAM file and then sort the reads based on their genomic coordinates.
-            sam_command = 'samtools view -bS {} | samtools sort -o {}'.format(chimp, final)
-            subprocess.call(sam_command, **shell_options)
-            subprocess.call('samtools index {} {}'.format(final, final_bai), **shell_options)
-            for r in pysam.Samfile(final):
-                yield r.qname
-        for temp_file in (chimp, final, error, final_bai):
+        # Only the names of the aligned reads are needed, so the SAM records are read straight from bowtie2 rather
+        # than being converted to a sorted, indexed BAM file first. Its messages go to a temporary file rather than a
+        # pipe, so they can't fill up and stall it while its output is being read.
+        with tempfile.TemporaryFile() as stderr:
+            proc = subprocess.Popen(command, stdout=subprocess.PIPE, stderr=stderr)
+            stopped_early = False
             try:
-                os.unlink(temp_file)
-            except (OSError, IOError):
-                log.warn("Unable to delete temp file: %s. "
-                         "Was it not created? You may be missing FASTQ reads." % temp_file)
+                for r in pysam.Samfile(proc.stdout):
+                    yield r.qname
+            except GeneratorExit:
+                stopped_early = True
+                raise
+            finally:
+                # If the caller stops early, closing the pipe makes bowtie2 exit
+                proc.stdout.close()
+                returncode = proc.wait()
+                # When bowtie2 fails, pysam usually fails too, on the empty output. bowtie2's own error is the
+                # useful one, so it replaces pysam's.
+                if returncode != 0 and not stopped_early:
+                    stderr.seek(0)
+                    raise IOError("bowtie2 failed with exit code %d: %s" % (returncode, stderr.read().strip()))
 
 
 def find_reads_using_bamfile(bamfile_path, fastq_files):
@@ -182,13 +197,13 @@ def find_reads_using_bamfile(bamfile_path, fastq_files):
 
 
 def get_max_edit_dist(target):
-    dists = [editdistance.eval(target, rand_seq(len(target))) for _ in xrange(1000)]
+    # All the random sequences are drawn at once, as the rows of a byte array
+    rand_codes = np.random.randint(4, size=(1000, len(target)))
+    rand_seqs = np.frombuffer('ACGT', dtype=np.uint8)[rand_codes].view('S%d' % len(target)).ravel().tolist()
+    dists = [editdistance.eval(target, seq) for seq in rand_seqs]
     return min(10, np.percentile(dists, 0.5))
 
 
-def rand_seq(seq_len):
-    return ''.join(random.choice('ACGT') for _ in xrange(seq_len))
-
 ### -----------------------------------------------
 # Here we also consider sequences having similar reads to our target.
 # If the fastq reads are longer than our target_sequence, we consider all possible edit distance by comparing the edit distance between target_seq and fastq reads having the same length.
@@ -198,46 +213,127 @@ def rand_seq(seq_len):
 # After min_edit_dist is calculated, we compare it with max_edit_dist. If min_edit_dist <= max_edit_dist, we will accept this read as it could be related to our target_seq.
 ### -----------------------------------------------
 def determine_target_reads(targets, read_names_given_seq):
+    # The sequences are grouped by length once, so the windows to compare are worked out once per length rather than
+    # once per sequence
+    seqs_by_len = defaultdict(list)
+    for seq, read_names in read_names_given_seq.iteritems():
+        seqs_by_len[len(seq)].append((seq, read_names))
+
+    # Targets that share a sequence share a threshold
+    max_edit_dists = {}
     for target_name, target_sequence in targets.items():
-        max_edit_dist = get_max_edit_dist(target_sequence)
-        for seq, read_names in read_names_given_seq.items():
-            if len(seq) > len(target_sequence):
-                min_edit_dist = min(editdistance.eval(target_sequence, seq[i:i + len(target_sequence)])
-                                    for i in xrange(len(seq) - len(target_sequence)))
+        if target_sequence not in max_edit_dists:
+            max_edit_dists[target_sequence] = get_max_edit_dist(target_sequence)
+        max_edit_dist = max_edit_dists[target_sequence]
+        # Distances are whole numbers, so this is the same limit
+        max_ham_dist = int(max_edit_dist)
+        target_len = len(target_sequence)
+        # The read names of all the matching sequences are gathered, so each target's names are written out at once
+        target_read_names = set()
+        for seq_len, seqs in seqs_by_len.iteritems():
+            if target_len - seq_len > max_edit_dist:
+                # The edit distance is at least the difference in length, so none of these can match
+                continue
+            if seq_len > target_len:
+                windows = xrange(seq_len - target_len)
+                for seq, read_names in seqs:
+                    # The edit distance between two sequences of the same length is never more than the hamming
+                    # distance, so a window with few enough mismatches settles it without any edit distances being
+                    # worked out. Only the starts in windows are considered.
+                    positions = find_adapter_positions(seq, target_sequence, target_len, max_ham_dist)
+                    if positions and positions[0] < len(windows):
+                        target_read_names.update(read_names)
+                    # Only whether some window is close enough matters, so the search stops at the first one that is
+                    elif any(editdistance.eval(target_sequence, seq[i:i + target_len]) <= max_edit_dist for i in windows):
+                        target_read_names.update(read_names)
             else:
-                min_edit_dist = editdistance.eval(target_sequence, seq)
-            if min_edit_dist <= max_edit_dist:
-                yield target_name, read_names
+                for seq, read_names in seqs:
+                    if editdistance.eval(target_sequence, seq) <= max_edit_dist:
+                        target_read_names.update(read_names)
+        if target_read_names:
+            yield target_name, target_read_names
 
 
 def write_read_names(read_names, target_name, output_directory, usable_read):
+    # read_names must already be free of duplicates. They're streamed into a large write buffer rather than joined
+    # into one string first.
     filename = os.path.join(output_directory, target_name + '_read_names.txt')
-    with open(filename, 'a') as f:
-        f.write('\n'.join(filter(lambda read_name: usable_read(read_name), set(read_names))) + '\n')
+    with open(filename, 'a', 1024 * 1024) as f:
+        f.writelines(read_name + '\n' for read_name in read_names if usable_read(read_name))
 
 
 def write_read_names_by_sequence(read_names_given_seq, out_file_path):
-    with open(out_file_path, 'w') as out:
-        for seq, read_names in sorted(read_names_given_seq.items()):
-            out.write('{}\t{}\n'.format(seq, '\t'.join(read_names)))
+    # Only the sequences are sorted, which is much quicker than sorting (seq, read_names) tuples. The lines are streamed
+    # into a large write buffer, as in write_all_read_names.
+    with open(out_file_path, 'w', 1024 * 1024) as out:
+        out.writelines('%s\t%s\n' % (seq, '\t'.join(read_names_given_seq[seq]))
+                       for seq in sorted(read_names_given_seq))
+    # The text file is what the analysis code reads, but later runs of this step load this binary copy instead, since
+    # it's much faster than splitting every line. It's written second so that it's never older than the text file.
+    with open(read_names_by_sequence_cache_path(out_file_path), 'wb') as out:
+        marshal.dump(dict(read_names_given_seq), out)
+
+
+def load_read_names_by_sequence(in_file_path):
+    cache_path = read_names_by_sequence_cache_path(in_file_path)
+    # Millions of lists are created here, and the garbage collector would otherwise scan all of them over and over
+    # as they pile up, even though none of them can be part of a reference cycle
+    gc_was_enabled = gc.isenabled()
+    gc.disable()
+    try:
+        if os.path.exists(cache_path) and os.path.getmtime(cache_path) >= os.path.getmtime(in_file_path):
+            try:
+                with open(cache_path, 'rb') as f:
+                    return marshal.load(f)
+            except (EOFError, ValueError, TypeError):
+                log.warn("Unable to load %s, reading %s instead." % (cache_path, in_file_path))
+        # Files from earlier versions don't have the binary copy, or the text file may have been changed since
+        read_names_given_seq = {}
+        with open(in_file_path) as f:
+            for line in f:
+                line = line.rstrip('\n').split('\t')
+                read_names_given_seq[line[0]] = line[1:]
+        return read_names_given_seq
+    finally:
+        if gc_was_enabled:
+            gc.enable()
+
+
+def read_names_by_sequence_cache_path(text_file_path):
+    return os.path.splitext(text_file_path)[0] + '.marshal'
 
 
 def write_all_read_names(fastq_files, out_file_path, usable_read):
     # Opens all FastQ files, finds every read name, and saves it in a file without any other data
-    with open(out_file_path, 'w') as out:
+    # The names are streamed into a large write buffer as the file is parsed, rather than collecting every record
+    # of the file first
+    with open(out_file_path, 'w', 1024 * 1024) as out:
         for (first, second) in fastq_files.paired:
             # only save read names from the second pair, otherwise we would include duplicates
             # and read names that were only found in the first run
-            for record in filter(lambda record: usable_read(record.id), parse_fastq_lines(second)):
-                out.write(record.name + '\n')
+            out.writelines(record.id + '\n' for record in parse_fastq_lines(second) if usable_read(record.id))
 
 # If a target sequence is identical to the sequence listed in the fastq reads, it is considered as a perfect_read_names 
 def determine_perfect_target_reads(targets, read_names_by_seq):
+    # All the sequences are joined into one string, so each target is found by a single scan of it rather than a
+    # separate substring test per sequence. starts holds the position of each sequence in the joined string.
+    seqs_and_read_names = read_names_by_seq.items()
+    joined_seqs = '\n'.join(seq for seq, _ in seqs_and_read_names)
+    starts = []
+    position = 0
+    for seq, _ in seqs_and_read_names:
+        starts.append(position)
+        position += len(seq) + 1
+
     for target_name, target_sequence in targets.items():
-        perfect_read_names = []
-        for seq, read_names in read_names_by_seq.items():
-            if target_sequence in seq:
-                perfect_read_names += read_names
+        perfect_read_names = set()
+        position = joined_seqs.find(target_sequence) if seqs_and_read_names else -1
+        while position != -1:
+            index = bisect.bisect_right(starts, position) - 1
+            seq, read_names = seqs_and_read_names[index]
+            perfect_read_names.update(read_names)
+            # Each sequence is only counted once, however many times the target appears in it
+            position = joined_seqs.find(target_sequence, starts[index] + len(seq) + 1)
         yield target_name, perfect_read_names
 
 ### ---------------------------
@@ -249,13 +345,14 @@ def determine_perfect_target_reads(targets, read_names_by_seq):
 # We compare the 10th percentile of  the dist list to i/4 and pick the smaller one as the max_ham_dists.
 ### --------------------------
 def get_max_ham_dists(min_len, max_len):
-    dists = defaultdict(list)
-    for _ in xrange(50000):
-        ref_seq = rand_seq(max_len)
-        new_seq = rand_seq(max_len)
-        for i in range(min_len, max_len+1):
-            dists[i].append(simple_hamming_distance(ref_seq[:i], new_seq[:i]))
-    max_ham_dists = [min(np.percentile(dists[i], 0.1), int(i/4)) for i in range(min_len, max_len+1)]
+    # All 50000 pairs of random sequences are drawn at once as rows of base codes. The hamming distance between the
+    # first i bases of each pair is the running count of mismatches at position i - 1.
+    ref_seqs = np.random.randint(4, size=(50000, max_len), dtype=np.uint8)
+    new_seqs = np.random.randint(4, size=(50000, max_len), dtype=np.uint8)
+    dists = np.cumsum(ref_seqs != new_seqs, axis=1, dtype=np.int16)[:, min_len - 1:]
+    lengths = np.arange(min_len, max_len + 1)
+    # Returned as doubles, since that's how unique_overlap_length takes them
+    max_ham_dists = np.minimum(np.percentile(dists, 0.1, axis=0), lengths // 4).astype(np.float64)
     return max_ham_dists
 
 
@@ -263,30 +360,56 @@ def get_max_ham_dists(min_len, max_len):
 # Pair fpaths and classify seqs
 # We first paired the reads from the two fastq files. Since the reads in the fastq files follow the same order, we use izip to directly link the two reads.
 # If the id does not follow user-defined requirements, it will not be defined as a usable_read (e.g., "2" for side2 only).
-# Based on the pair-end readings, we can then classify the sequence using "classify_seq".
+# Based on the pair-end readings, we can then classify the sequence using "classify_seqs".
 # --------------------------------------------------------------------------------
-def determine_sequences_of_read_names(min_len, max_len, log_p_struct, fastq_files, usable_read):
+def determine_sequences_of_read_names(min_len, max_len, log_p_table, fastq_files, usable_read):
     max_ham_dists = get_max_ham_dists(min_len, max_len)
     log.debug("Max ham dists: %s" % str(max_ham_dists))
+    paired = list(fastq_files.paired)
+
+    # Each pair of FastQ files is classified in its own process. With only one pair (or one core) it's done here, since
+    # sending the results back from a worker would only add to the time taken.
+    global _usable_read
+    _usable_read = usable_read
+    num_processes = min(len(paired), multiprocessing.cpu_count())
+    # The files are only read in threads of their own if there are cores left over for them to run on
+    read_ahead = multiprocessing.cpu_count() > num_processes
+    classify_func = functools.partial(classify_fastq_pair, min_len, max_len, max_ham_dists, log_p_table, read_ahead)
+    pool = multiprocessing.Pool(num_processes) if num_processes > 1 else None
+    # imap returns the results in the order of the files, so the read names are merged in the same order as before
+    results = pool.imap(classify_func, paired) if pool else itertools.imap(classify_func, paired)
     read_names_given_seq = defaultdict(list)
-    for fpath1, fpath2 in fastq_files.paired:
-        log.debug('{}, {}'.format(*map(os.path.basename, (fpath1, fpath2))))
-        discarded = 0
-        total = 0
-        for i, (rec1, rec2) in enumerate(
-                itertools.izip(parse_fastq_lines(fpath1),
-                               parse_fastq_lines(fpath2))
-        ):
-            if not usable_read(rec1.id):
-                continue
-            total += 1
-            seq = classify_seq(rec1, rec2, min_len, max_len, max_ham_dists, log_p_struct)
+    for pair_read_names_given_seq in results:
+        for seq, read_names in pair_read_names_given_seq.iteritems():
+            read_names_given_seq[seq].extend(read_names)
+    if pool:
+        pool.close()
+        pool.join()
+    _usable_read = None
+    return read_names_given_seq
+
+
+def classify_fastq_pair(min_len, max_len, max_ham_dists, log_p_table, read_ahead, fpaths):
+    fpath1, fpath2 = fpaths
+    log.debug('{}, {}'.format(*map(os.path.basename, (fpath1, fpath2))))
+    read_names_given_seq = defaultdict(list)
+    discarded = 0
+    total = 0
+    records1, records2 = parse_fastq_lines(fpath1), parse_fastq_lines(fpath2)
+    if read_ahead:
+        # Each file is read in a thread of its own, so decompressing one doesn't hold up the other
+        records1, records2 = prefetch(records1), prefetch(records2)
+    usable_pairs = ((rec1, rec2) for rec1, rec2 in itertools.izip(records1, records2) if _usable_read(rec1.id))
+    # The consensus sequences are worked out for a batch of read pairs at a time
+    for pairs in iter(lambda: list(itertools.islice(usable_pairs, CLASSIFY_BATCH_SIZE)), []):
+        total += len(pairs)
+        for (rec1, _), seq in itertools.izip(pairs, classify_seqs(pairs, min_len, max_len, max_ham_dists, log_p_table)):
             if seq:
-                read_names_given_seq[seq].append(str(rec1.id))
+                read_names_given_seq[seq].append(rec1.id)
             else:
                 discarded += 1
-        found = total - discarded
-        log.debug('Found {} of {} ({:.1f}%)'.format(found, total, 100 * found / float(total)))
+    found = total - discarded
+    log.debug('Found {} of {} ({:.1f}%)'.format(found, total, 100 * found / float(total)))
     return read_names_given_seq
 
 
@@ -299,29 +422,46 @@ def determine_side(record_id):
     return record_id.split(":")[4][0]
 
 
-def classify_seq(rec1, rec2, min_len, max_len, max_ham_dists, log_p_struct):
-    bases = set('ACGT')
+def find_overlap(rec1, rec2, min_len, max_len, max_ham_dists):
     # Store as strings
-    seq1 = str(rec1.seq)
-    seq2_rc = str(rec2.seq.reverse_complement())
+    seq1 = rec1.seq
+    seq2_rc = rec2.seq.translate(COMPLEMENT)[::-1]
     loc_max_len = min(max_len, len(seq1), len(seq2_rc))
 
     # Find aligning sequence, indels are not allowed, starts of reads included
     # Here we check if the hamming distance between pair-end reads is smaller than max_ham.
-    # We only consider one signature length.
-    sig_lens = [i for i, max_ham in zip(range(min_len, loc_max_len + 1), max_ham_dists)
-                if simple_hamming_distance(seq1[:i], seq2_rc[-i:]) < max_ham]
-    if len(sig_lens) != 1:
+    # We only consider one signature length, so the search stops as soon as a second one turns up.
+    seq2_len = unique_overlap_length(seq1, seq2_rc, min_len, loc_max_len, max_ham_dists)
+    if seq2_len == -1:
         return None
 
-    seq2_len = sig_lens[0]
     seq2_match = seq2_rc[-seq2_len:]
     seq1_match = seq1[:seq2_len]
     
     # To build consensus sequences, we need to first consider the sequencing reads quality base-by-base.
     # Therefore, we first get corresponding quality scores of the pair-end reads at each position.
-    quals1 = rec1.letter_annotations['phred_quality'][:seq2_len]
-    quals2 = rec2.letter_annotations['phred_quality'][::-1][-seq2_len:]
+    quals1 = rec1.qualities[:seq2_len]
+    quals2 = rec2.qualities[::-1][-seq2_len:]
+    return seq1_match, seq2_match, quals1, quals2
+
+
+def classify_seqs(pairs, min_len, max_len, max_ham_dists, log_p_table):
+    """
+    Determines the consensus sequence of each pair of reads, or None if there isn't one. The overlaps of all the
+    pairs are joined end to end, so the consensus of the whole batch is worked out with a handful of array operations.
+
+    """
+    overlaps = [find_overlap(rec1, rec2, min_len, max_len, max_ham_dists) for rec1, rec2 in pairs]
+    found = [overlap for overlap in overlaps if overlap is not None]
+    if not found:
+        return [None] * len(overlaps)
+    seq1_matches, seq2_matches, quals1, quals2 = zip(*found)
+    lengths = np.array([len(seq) for seq in seq1_matches])
+    starts = np.cumsum(lengths) - lengths
+    read1 = np.frombuffer(''.join(seq1_matches), dtype=np.uint8)
+    read2 = np.frombuffer(''.join(seq2_matches), dtype=np.uint8)
+    quals1 = np.frombuffer(''.join(quals1), dtype=np.uint8).astype(np.intp) - 33
+    quals2 = np.frombuffer(''.join(quals2), dtype=np.uint8).astype(np.intp) - 33
 
     ### ----------------------------------
     # To build consensus sequence, we need to consider several possible conditions:
@@ -330,30 +470,142 @@ def classify_seq(rec1, rec2, min_len, max_len, max_ham_dists, log_p_struct):
     # 3. If either one is has no read (perhaps due to shorter read length) and the other one has phred quality score > 2, we accept the read.
     # 4. If no conditions above is qualified, the sequence will be noted as "None".
     ### ----------------------------------
-    ML_bases = []
-    for r1, q1, r2, q2 in zip(seq1_match, quals1, seq2_match, quals2):
-        if r1 in bases and r1 == r2:
-            ML_bases.append(r1)
-        elif set([r1, r2]) <= bases and q1 > 2 and q2 > 2:
-            r1_score = log_p_struct[r1][r1][q1] + log_p_struct[r1][r2][q2]
-            r2_score = log_p_struct[r2][r1][q1] + log_p_struct[r2][r2][q2]
-            if r1_score > r2_score:
-                ML_bases.append(r1)
-            else:
-                ML_bases.append(r2)
-        elif r1 in bases and q1 > 2:
-            ML_bases.append(r1)
-        elif r2 in bases and q2 > 2:
-            ML_bases.append(r2)
-        else:
-            return None
-    return ''.join(ML_bases)
+    # Each condition is a mask over every base. Where the reads agree either one can be taken, so read 1 is used
+    # wherever it's good unless read 2 is good too and scores higher.
+    codes1 = BASE_CODES[read1]
+    codes2 = BASE_CODES[read2]
+    is_base1 = codes1 < 4
+    good1 = is_base1 & (quals1 > 2)
+    good2 = (codes2 < 4) & (quals2 > 2)
+    same = is_base1 & (codes1 == codes2)
+    unusable = np.logical_or.reduceat(~(same | good1 | good2), starts)
+
+    # The scores are only looked up where both reads have a good base and they disagree
+    idx = np.flatnonzero(good1 & good2 & ~same)
+    c1, c2, q1, q2 = codes1[idx], codes2[idx], quals1[idx], quals2[idx]
+    r1_score = log_p_table[c1, c1, q1] + log_p_table[c1, c2, q2]
+    r2_score = log_p_table[c2, c1, q1] + log_p_table[c2, c2, q2]
+    use_read1 = good1
+    use_read1[idx] = r1_score > r2_score
+    consensus = np.where(use_read1, read1, read2).tostring()
+
+    seqs = iter([None if discard else consensus[start:start + length]
+                 for start, length, discard in itertools.izip(starts.tolist(), lengths.tolist(), unusable.tolist())])
+    return [None if overlap is None else next(seqs) for overlap in overlaps]
+
+
+def load_log_p_table(log_p_file_path):
+    # The pickled log_p_struct is converted into the table classify_seqs uses as soon as it's loaded
+    with open(log_p_file_path) as f:
+        return log_p_table_from_struct(pickle.load(f))
+
+
+def log_p_table_from_struct(log_p_struct):
+    """
+    Converts log_p_struct, which is indexed as [true base][read base][quality], into an array indexed by the codes in
+    BASE_CODES, so the scores of many bases can be looked up at once.
+
+    """
+    num_quals = len(log_p_struct['A']['A'])
+    log_p_table = np.zeros((4, 4, num_quals))
+    for i, true_base in enumerate('ACGT'):
+        for j, read_base in enumerate('ACGT'):
+            log_p_table[i, j] = log_p_struct[true_base][read_base]
+    return log_p_table
 
 
 def parse_fastq_lines(gzipped_filename):
-    with gzip.open(gzipped_filename) as fh:
-        for record in SeqIO.parse(fh, 'fastq'):
+    # When pigz is available, the file is decompressed in a separate process so that decompression and parsing
+    # run on different cores
+    pigz = find_executable('pigz')
+    if pigz is None:
+        with gzip.open(gzipped_filename) as fh:
+            for record in read_fastq_records(io.BufferedReader(fh, 1 << 20)):
+                yield record
+        return
+
+    proc = subprocess.Popen([pigz, '-cd', gzipped_filename], stdout=subprocess.PIPE, bufsize=1 << 20)
+    finished = False
+    try:
+        for record in read_fastq_records(proc.stdout):
             yield record
+        finished = True
+    finally:
+        # If the caller stops early, closing the pipe makes pigz exit
+        proc.stdout.close()
+        returncode = proc.wait()
+    if finished and returncode != 0:
+        raise IOError("pigz could not decompress %s (exit code %d)" % (gzipped_filename, returncode))
+
+
+def prefetch(iterable, chunk_size=1000, max_chunks=16):
+    """
+    Iterates over iterable in a background thread, up to max_chunks chunks ahead of the caller. Items are handed over a
+    chunk at a time, since passing each one through the queue would cost more than the time saved. Exceptions are
+    raised in the caller, and if the caller stops early the thread closes iterable and exits.
+
+    """
+    chunks = Queue.Queue(max_chunks)
+    stop = threading.Event()
+
+    def put(item):
+        # Gives up once the caller has gone away, rather than waiting forever for room in the queue
+        while not stop.is_set():
+            try:
+                chunks.put(item, timeout=0.1)
+                return True
+            except Queue.Full:
+                pass
+        return False
+
+    def produce():
+        items = iter(iterable)
+        try:
+            chunk = True
+            # An empty chunk tells the caller that there's nothing left
+            while chunk:
+                chunk = list(itertools.islice(items, chunk_size))
+                if not put((chunk, None)):
+                    break
+        except Exception:
+            put((None, sys.exc_info()))
+        finally:
+            if hasattr(items, 'close'):
+                items.close()
+
+    thread = threading.Thread(target=produce)
+    thread.daemon = True
+    thread.start()
+    try:
+        while True:
+            chunk, error = chunks.get()
+            if error is not None:
+                raise error[0], error[1], error[2]
+            if not chunk:
+                return
+            for item in chunk:
+                yield item
+    finally:
+        stop.set()
+
+
+def read_fastq_records(fh):
+    """
+    Reads the four lines of each FastQ record. Like Bio.SeqIO, only the first word of the title is kept as the id.
+    The qualities are left as the Phred+33 encoded string.
+
+    """
+    lines = iter(fh)
+    for title in lines:
+        if not title.strip():
+            continue
+        try:
+            seq, _, qualities = next(lines).rstrip(), next(lines), next(lines).rstrip()
+        except StopIteration:
+            raise ValueError("FastQ file ends in the middle of a record: %s" % title.rstrip())
+        if title[0] != '@' or len(seq) != len(qualities):
+            raise ValueError("Malformed FastQ record: %s" % title.rstrip())
+        yield FastqRecord(title[1:].split(None, 1)[0], seq, qualities)
 
 
 def isint(a):